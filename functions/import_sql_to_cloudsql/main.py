@@ -1,13 +1,16 @@
 import os
 import json
 import base64
-import subprocess
+from googleapiclient import discovery
+from googleapiclient.errors import HttpError
 
 PROJECT_ID = os.environ.get("GCP_PROJECT", "project-64f58cb2-a1cc-4618-9a0")
 BUCKET_NAME = os.environ.get("BUCKET_NAME", "project-64f58cb2-data-analysis")
 INSTANCE_NAME = os.environ.get("CLOUDSQL_INSTANCE", "data-analysis-db")
 DATABASE_NAME = os.environ.get("CLOUDSQL_DATABASE", "data_analysis")
-REGION = os.environ.get("REGION", "asia-southeast1")
+
+# Cloud SQL Admin API client, reused across invocations (no gcloud subprocess)
+sql_admin = discovery.build("sqladmin", "v1beta4", cache_discovery=False)
 
 def import_sql(event, context):
     pubsub_message = json.loads(base64.b64decode(event['data']).decode('utf-8'))
@@ -19,16 +22,22 @@ def import_sql(event, context):
         return
 
     gcs_path = f"gs://{bucket_name}/{file_name}"
+    body = {
+        "importContext": {
+            "uri": gcs_path,
+            "database": DATABASE_NAME,
+            "fileType": "SQL"
+        }
+    }
     try:
-        subprocess.run(
-            [
-                "gcloud", "sql", "import", "sql", INSTANCE_NAME, gcs_path,
-                "--project", PROJECT_ID,
-                "--database", DATABASE_NAME,
-                f"--region={REGION}"
-            ],
-            check=True
-        )
-        print(f"Import completed for {file_name}")
-    except subprocess.CalledProcessError as e:
+        # Fire-and-forget: the import runs server-side as a Cloud SQL operation
+        operation = sql_admin.instances().import_(
+            project=PROJECT_ID, instance=INSTANCE_NAME, body=body
+        ).execute()
+        print(f"Import started for {file_name} (operation: {operation.get('name')})")
+    except HttpError as e:
         print(f"Error importing {file_name}: {e}")
+        # Conflicts (another import still running), throttling and server errors are
+        # transient: re-raise so Pub/Sub redelivers the message
+        if e.resp.status in (409, 429) or e.resp.status >= 500:
+            raise
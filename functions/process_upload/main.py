@@ -1,13 +1,32 @@
 import os
 import json
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
 from google.cloud import bigquery, pubsub_v1
 
 PROJECT_ID = os.environ.get('GCP_PROJECT', 'project-64f58cb2-a1cc-4618-9a0')
 BIGQUERY_DATASET = os.environ.get('BIGQUERY_DATASET', 'analysis_dataset')
 PUBSUB_TOPIC_FOR_SQL_IMPORT = os.environ.get('PUBSUB_TOPIC_FOR_SQL_IMPORT', 'sql-import-topic')
 
-bq_client = bigquery.Client()
-publisher = pubsub_v1.PublisherClient()
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '32'))
+
+def _pooled_session():
+    """
+    Authorized HTTP session with a connection pool sized for bursty invocations.
+    Returns (credentials, session); a client given _http alone has no credentials.
+    """
+    credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    return credentials, session
+
+_credentials, _http = _pooled_session()
+bq_client = bigquery.Client(project=PROJECT_ID, credentials=_credentials, _http=_http)
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(max_messages=100, max_latency=0.05, max_bytes=1 << 20)
+)
 topic_path = publisher.topic_path(PROJECT_ID, PUBSUB_TOPIC_FOR_SQL_IMPORT)
 
 def process_upload(event, context):
@@ -27,4 +46,7 @@ def process_upload(event, context):
 
     elif file_name.endswith('.sql'):
         message_data = {'name': file_name, 'bucket': bucket_name}
-        publisher.publish(topic_path, data=json.dumps(message_data).encode('utf-8'))
+        future = publisher.publish(topic_path, data=json.dumps(message_data).encode('utf-8'))
+        # Wait for delivery before the function exits; the sandbox is frozen afterwards
+        future.result(timeout=30)
+        print(f"Published import request for {file_name}")
@@ -1,4 +1,6 @@
 import os
+from cachetools import TTLCache
+from google.api_core.exceptions import NotFound
 from google.cloud import bigquery, storage
 from flask import Request
 
@@ -9,41 +11,29 @@ BUCKET_NAME = os.environ.get('BUCKET_NAME', 'project-64f58cb2-data-analysis')
 bq_client = bigquery.Client()
 storage_client = storage.Client()
 
-# Define a flexible schema for analysis results (auto-detected from source)
-def get_dynamic_schema(table_name):
-    """Create schema based on source table structure."""
-    try:
-        table_ref = bq_client.dataset(BIGQUERY_DATASET).table(table_name)
-        table = bq_client.get_table(table_ref)
-        return table.schema
-    except Exception:
-        # Fallback to basic schema if table doesn't exist
-        return [
-            bigquery.SchemaField("department", "STRING"),
-            bigquery.SchemaField("amount", "FLOAT"),
-            bigquery.SchemaField("date", "TIMESTAMP"),
-            bigquery.SchemaField("expense_type", "STRING")
-        ]
-
-def _dataset_location():
-    """Read actual dataset location (safer than assuming)."""
+# Metadata caches (warm instances skip repeated BigQuery round-trips)
+_table_cache = TTLCache(maxsize=256, ttl=300)
+
+def _table_exists(table_fq):
+    """Return True if the table exists. Only positive answers are cached."""
+    if table_fq in _table_cache:
+        return True
     try:
-        ds = bq_client.get_dataset(f"{PROJECT_ID}.{BIGQUERY_DATASET}")
-        return ds.location or "US"  # Default to US if location is not set
-    except Exception as e:
-        print(f"Error getting dataset location: {e}")
-        return "US"  # Fallback location
-    
+        bq_client.get_table(table_fq)
+    except NotFound:
+        return False
+    _table_cache[table_fq] = True
+    return True
+
 def create_table_from_csv_if_not_exists(table_name):
     """Creates a BigQuery table from a CSV in GCS if it doesn't exist."""
     table_ref = bq_client.dataset(BIGQUERY_DATASET).table(table_name)
-    try:
-        bq_client.get_table(table_ref)
+    table_fq = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}"
+    if _table_exists(table_fq):
         return  # Table already exists
-    except Exception:
-        print(f"Table {table_name} not found. Searching for CSV in GCS...")
+    print(f"Table {table_name} not found. Searching for CSV in GCS...")
 
-    # Possible CSV paths
+    # Possible CSV paths, in order of preference
     possible_paths = [
         f"{table_name}.csv",
         f"uploads/{table_name}.csv",
@@ -51,12 +41,18 @@ def create_table_from_csv_if_not_exists(table_name):
         f"raw/{table_name}.csv"
     ]
 
-    bucket = storage_client.bucket(BUCKET_NAME)
+    # One LIST request matching all candidates instead of a HEAD per path
+    blobs = storage_client.list_blobs(
+        BUCKET_NAME,
+        match_glob="{" + ",".join(possible_paths) + "}",
+        max_results=len(possible_paths),
+        fields="items(name),nextPageToken"
+    )
+    found = {blob.name for blob in blobs}
     csv_uri = None
 
     for path in possible_paths:
-        blob = bucket.blob(path)
-        if blob.exists():
+        if path in found:
             csv_uri = f"gs://{BUCKET_NAME}/{path}"
             print(f"Found CSV at {path}")
             break
@@ -68,11 +64,14 @@ def create_table_from_csv_if_not_exists(table_name):
     job_config = bigquery.LoadJobConfig(
         source_format=bigquery.SourceFormat.CSV,
         skip_leading_rows=1,
-        autodetect=True
+        autodetect=True,
+        # Never append to a table that appeared since the existence check
+        write_disposition=bigquery.WriteDisposition.WRITE_EMPTY
     )
 
     load_job = bq_client.load_table_from_uri(csv_uri, table_ref, job_config=job_config)
     load_job.result()
+    _table_cache[table_fq] = True
     print(f"Created BigQuery table {table_name} from CSV: {csv_uri}")
 
 def run_analysis(request: Request):
@@ -84,36 +83,29 @@ def run_analysis(request: Request):
     # Ensure table exists (create if CSV available)
     create_table_from_csv_if_not_exists(table_name)
 
-    # Query first 10 rows
+    # Materialize the first 10 rows server-side into the analysis table
     query = f"SELECT * FROM `{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}` LIMIT 10"
-    results = bq_client.query(query).result()
-
-    # Save results to CSV in /tmp
-    result_file = "/tmp/results.csv"
-    with open(result_file, "w") as f:
-        headers = [field.name for field in results.schema]
-        f.write(",".join(headers) + "\n")
-        for row in results:
-            f.write(",".join([str(x) for x in row.values()]) + "\n")
-
-    # Upload analysis results to GCS
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"analysis_results/{table_name}_results.csv")
-    blob.upload_from_filename(result_file)
-
-    # Load into BigQuery analysis table with dynamic schema
     destination_table = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}_analysis"
-    job_config = bigquery.LoadJobConfig(
-        schema=get_dynamic_schema(table_name),
-        source_format=bigquery.SourceFormat.CSV,
-        skip_leading_rows=1,
+    job_config = bigquery.QueryJobConfig(
+        destination=destination_table,
         write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
         create_disposition=bigquery.CreateDisposition.CREATE_IF_NEEDED
     )
-
-    with open(result_file, "rb") as source_file:
-        load_job = bq_client.load_table_from_file(source_file, destination_table, job_config=job_config)
-        load_job.result()
+    rows = bq_client.query(query, job_config=job_config).result()
+
+    # Export analysis results to GCS (no data passes through the function).
+    # CSV can't hold nested or repeated fields, so those tables go out as NDJSON.
+    nested = any(f.field_type in ("RECORD", "STRUCT") or f.mode == "REPEATED" for f in rows.schema)
+    if nested:
+        destination_uri = f"gs://{BUCKET_NAME}/analysis_results/{table_name}_results.json"
+        extract_config = bigquery.ExtractJobConfig(
+            destination_format=bigquery.DestinationFormat.NEWLINE_DELIMITED_JSON
+        )
+    else:
+        destination_uri = f"gs://{BUCKET_NAME}/analysis_results/{table_name}_results.csv"
+        extract_config = None
+    extract_job = bq_client.extract_table(destination_table, destination_uri, job_config=extract_config)
+    extract_job.result()
 
     return (
         f"Analysis complete for table '{table_name}'.\n"
@@ -0,0 +1,16 @@
+"""
+Gunicorn settings for the production web app (see Dockerfile).
+Threaded workers keep long BigQuery/GCS calls from blocking other users.
+"""
+
+import multiprocessing
+import os
+
+bind = f":{os.environ.get('PORT', '8080')}"
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 600))
+keepalive = 2
+max_requests = 1000
+max_requests_jitter = 50
@@ -1,24 +1,73 @@
-from flask import Flask, request, render_template, send_file, jsonify, g
+from flask import Flask, request, render_template, jsonify, g, Response
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.utils import secure_filename
+from werkzeug.http import dump_options_header
+from urllib.parse import quote
+import unicodedata
 import os
-import json
+import orjson
 import csv
+import shutil
+import tempfile
+import uuid
+import hashlib
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.csv as pacsv
+import openpyxl
 import logging
 import time
+import threading
 from functools import wraps
-from google.cloud import storage, bigquery
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cachetools import TTLCache, cached
+from google.cloud import storage, bigquery, bigquery_storage
 from google.cloud import pubsub_v1
+from google.cloud.storage import transfer_manager
+from google.cloud import tasks_v2
+import google.auth
+from google.oauth2 import id_token
+from google.auth.transport import requests as google_auth_requests
 import re
 import io
+import google_crc32c
+import string
 from google.api_core.exceptions import NotFound
+from google.api_core.gapic_v1.client_info import ClientInfo
+from google.cloud.bigquery_storage_v1.services.big_query_read.transports import BigQueryReadGrpcTransport
+from google.pubsub_v1.services.publisher.transports import PublisherGrpcTransport
+from requests.adapters import HTTPAdapter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson; falls back to Flask's encoder for Decimal, dates, etc."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'dev-secret-change-in-production')  # Use environment variable in production
 
+# Oversize uploads are refused from the Content-Length header, before any of the body is read
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 2 * 1024 * 1024 * 1024))
+
+@app.errorhandler(413)
+def request_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({"success": False, "error": f"File too large. Maximum upload size is {limit_mb} MB."}), 413
+
 # ===============================
 # 🔹 Security Middleware
 # ===============================
@@ -34,30 +83,69 @@ def add_security_headers(response):
     return response
 
 # Simple rate limiting (in production, use Redis or Cloud Memorystore)
-rate_limit_storage = {}
+# Storage is split into shards, each with its own lock, so concurrent
+# threads only contend when their client IPs hash to the same shard.
+# Entries are keyed by (route, client IP) so each route keeps its own limit.
+_RATE_LIMIT_SHARDS = 16
+_RATE_LIMIT_SWEEP_EVERY = 256
+rate_limit_storage = [(threading.Lock(), {}) for _ in range(_RATE_LIMIT_SHARDS)]
+_rate_limit_windows = {}  # route -> window_seconds, for the sweep
+_rate_limit_calls = 0
+_rate_limit_calls_lock = threading.Lock()
+
+def _sweep_rate_limit_shard(calls, now):
+    """Drop idle (route, IP) entries from one shard per call, round-robin."""
+    lock, store = rate_limit_storage[(calls // _RATE_LIMIT_SWEEP_EVERY) % _RATE_LIMIT_SHARDS]
+    with lock:
+        idle = [key for key, dq in store.items()
+                if not dq or now - dq[-1] >= _rate_limit_windows[key[0]]]
+        for key in idle:
+            del store[key]
+
+def _client_ip():
+    """Original client IP: first X-Forwarded-For hop, else the socket peer."""
+    xff = request.headers.get('X-Forwarded-For')
+    return xff.split(',', 1)[0].strip() if xff else request.remote_addr
 
 def rate_limit(max_requests=10, window_seconds=60):
     """Simple rate limiting decorator."""
     def decorator(f):
+        route = f.__name__
+        _rate_limit_windows[route] = window_seconds
+
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
+            global _rate_limit_calls
+            client_ip = _client_ip()
+            key = (route, client_ip)
             now = time.time()
-            
-            # Clean old entries
-            rate_limit_storage[client_ip] = [
-                req_time for req_time in rate_limit_storage.get(client_ip, [])
-                if now - req_time < window_seconds
-            ]
-            
-            # Check rate limit
-            if len(rate_limit_storage[client_ip]) >= max_requests:
-                logger.warning(f"Rate limit exceeded for IP: {client_ip}")
+
+            lock, store = rate_limit_storage[hash(client_ip) % _RATE_LIMIT_SHARDS]
+            with lock:
+                dq = store.get(key)
+                if dq is None:
+                    dq = store[key] = deque(maxlen=max_requests)
+
+                # Clean old entries
+                while dq and now - dq[0] >= window_seconds:
+                    dq.popleft()
+
+                # Check rate limit
+                limited = len(dq) >= max_requests
+                if not limited:
+                    dq.append(now)
+
+            # Periodically forget idle IPs so memory stays bounded
+            with _rate_limit_calls_lock:
+                _rate_limit_calls += 1
+                calls = _rate_limit_calls
+            if calls % _RATE_LIMIT_SWEEP_EVERY == 0:
+                _sweep_rate_limit_shard(calls, now)
+
+            if limited:
+                logger.warning("Rate limit exceeded for IP: %s", client_ip)
                 return jsonify({"error": "Rate limit exceeded. Please try again later."}), 429
-            
-            # Add current request
-            rate_limit_storage.setdefault(client_ip, []).append(now)
-            
+
             return f(*args, **kwargs)
         return decorated_function
     return decorator
@@ -95,111 +183,429 @@ PROJECT_ID = os.environ.get('GCP_PROJECT', 'project-64f58cb2-a1cc-4618-9a0')
 BUCKET_NAME = os.environ.get('BUCKET_NAME', 'project-64f58cb2-data-analysis')
 PUBSUB_TOPIC_FOR_SQL_IMPORT = os.environ.get('PUBSUB_TOPIC_FOR_SQL_IMPORT', 'sql-import-topic')
 BIGQUERY_DATASET = os.environ.get('BIGQUERY_DATASET', 'analysis_dataset')
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB copy buffer for uploads
+GCS_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # resumable upload chunk (multiple of 256 KiB)
+GCS_CHECKSUM = 'crc32c'  # verified end-to-end by GCS; hardware-accelerated via google-crc32c
+# Large SQL dumps are spooled to disk and uploaded as parallel XML multipart parts
+PARALLEL_UPLOAD_THRESHOLD = 150 * 1024 * 1024
+PARALLEL_UPLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+PARALLEL_UPLOAD_WORKERS = int(os.environ.get('PARALLEL_UPLOAD_WORKERS', '8'))
+
+# Clients (created once per process and shared by all request threads)
+CLIENT_INFO = ClientInfo(user_agent="gcp-data-analysis/1.0")
+GRPC_CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    # Keep idle channels alive so requests after a quiet period don't pay for a reconnect.
+    # Pings must be allowed with no call in flight, and without data frames in between;
+    # Google front ends accept a ping every 30s or slower.
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+# HTTP keep-alive pool per REST client; sized above gunicorn threads + parallel upload workers
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '32'))
+
+def _pooled_session():
+    """
+    Authorized HTTP session whose connection pool covers all request and upload threads.
+    Returns (credentials, session); clients need both, since _http alone leaves them credential-less.
+    """
+    credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+    session = google_auth_requests.AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    return credentials, session
+
+def _create_bqs_client():
+    """BigQuery Storage Read client (Arrow result streaming) on a keepalive gRPC channel."""
+    channel = BigQueryReadGrpcTransport.create_channel(options=GRPC_CHANNEL_OPTIONS)
+    return bigquery_storage.BigQueryReadClient(
+        transport=BigQueryReadGrpcTransport(channel=channel, client_info=CLIENT_INFO)
+    )
 
-# Clients
-storage_client = storage.Client()
-bq_client = bigquery.Client()
-publisher = pubsub_v1.PublisherClient()
+_gcs_credentials, _gcs_http = _pooled_session()
+storage_client = storage.Client(client_info=CLIENT_INFO, credentials=_gcs_credentials, _http=_gcs_http)
+# Upload checksums silently fall back to pure Python if the C extension is missing
+if google_crc32c.implementation == "c":
+    logger.info("google-crc32c: using the C extension for upload checksums")
+else:
+    logger.warning("google-crc32c: using the %s fallback; large GCS uploads will be CPU-bound", google_crc32c.implementation)
+_bq_credentials, _bq_http = _pooled_session()
+bq_client = bigquery.Client(client_info=CLIENT_INFO, credentials=_bq_credentials, _http=_bq_http)
+bqs_client = _create_bqs_client()
+
+# Background processing via Cloud Tasks. When TASKS_QUEUE is unset, uploads
+# are loaded and analysed synchronously inside the request instead.
+TASKS_QUEUE = os.environ.get('TASKS_QUEUE')
+TASKS_LOCATION = os.environ.get('TASKS_LOCATION', 'asia-southeast1')
+TASKS_SERVICE_ACCOUNT = os.environ.get('TASKS_SERVICE_ACCOUNT')
+SERVICE_URL = os.environ.get('SERVICE_URL')  # Cloud Run URL that tasks are delivered to
+if TASKS_QUEUE and not (SERVICE_URL and TASKS_SERVICE_ACCOUNT):
+    # Tasks without a target URL and OIDC identity would only fail at delivery
+    logger.error("TASKS_QUEUE is set but SERVICE_URL and TASKS_SERVICE_ACCOUNT are both required; "
+                 "Cloud Tasks disabled, uploads will be processed synchronously")
+    TASKS_QUEUE = None
+tasks_client = tasks_v2.CloudTasksClient() if TASKS_QUEUE else None
+tasks_queue_path = tasks_client.queue_path(PROJECT_ID, TASKS_LOCATION, TASKS_QUEUE) if TASKS_QUEUE else None
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(max_messages=100, max_latency=0.05, max_bytes=1_000_000),
+    transport=PublisherGrpcTransport(
+        channel=PublisherGrpcTransport.create_channel(options=GRPC_CHANNEL_OPTIONS), client_info=CLIENT_INFO
+    ),
+)
 topic_path = publisher.topic_path(PROJECT_ID, PUBSUB_TOPIC_FOR_SQL_IMPORT)
+gcs_bucket = storage_client.bucket(BUCKET_NAME)
+
+def _log_publish_result(future):
+    """Log Pub/Sub publish failures without blocking the request on the future."""
+    exc = future.exception()
+    if exc is not None:
+        logger.error("Pub/Sub publish failed: %s", exc)
+
+# Metadata caches (avoid a BigQuery round-trip per request)
+_known_datasets = set()
+_table_cache = TTLCache(maxsize=256, ttl=300)
+_schema_cache = TTLCache(maxsize=256, ttl=300)
+_columns_cache = TTLCache(maxsize=256, ttl=300)
+_cache_lock = threading.Lock()
 
 # ===============================
 # 🔹 Helper functions
 # ===============================
+_TABLE_NAME_RE = re.compile(r'^[a-zA-Z0-9_]{1,128}\Z', re.ASCII)
+_SQL_KEYWORDS = frozenset({'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'DROP', 'CREATE', 'ALTER', 'EXEC', 'UNION', 'WHERE', 'JOIN'})
+_TABLE_NAME_TRANS = str.maketrans(' ', '_')  # filename stem -> table name
+ALLOWED_EXTENSIONS = frozenset({'.sql', '.xlsx', '.xls', '.csv', '.json', '.parquet'})
+
 def validate_table_name(table_name):
     """Strict table name validation to prevent SQL injection."""
     if not table_name:
         raise ValueError("Table name cannot be empty")
     
     # Only allow alphanumeric characters and underscores
-    if not re.match(r'^[a-zA-Z0-9_]{1,128}$', table_name):
+    if not _TABLE_NAME_RE.match(table_name):
         raise ValueError("Invalid table name. Only letters, numbers, and underscores allowed (max 128 chars)")
     
     # Prevent SQL keywords
-    sql_keywords = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'DROP', 'CREATE', 'ALTER', 'EXEC', 'UNION', 'WHERE', 'JOIN'}
-    if table_name.upper() in sql_keywords:
+    if table_name.upper() in _SQL_KEYWORDS:
         raise ValueError("Table name cannot be a SQL keyword")
     
     return table_name
 
 def ensure_dataset_exists(dataset_id):
     """Create dataset if it doesn't already exist."""
+    if dataset_id in _known_datasets:
+        return
     dataset_ref = bq_client.dataset(dataset_id)
     try:
         bq_client.get_dataset(dataset_ref)
     except Exception:
         dataset = bigquery.Dataset(dataset_ref)
         dataset.location = "asia-southeast1"  # Match your region
-        bq_client.create_dataset(dataset)
+        bq_client.create_dataset(dataset, exists_ok=True)
+    _known_datasets.add(dataset_id)
 
-def load_to_bigquery(file_path, filename, table_name):
-    """Loads supported file types into BigQuery with autodetect schema."""
+# Bootstrap the dataset at startup so requests normally skip the RPC;
+# ensure_dataset_exists() stays as a cheap lazy fallback if this fails
+# (e.g. IAM not yet propagated when the instance starts).
+try:
     ensure_dataset_exists(BIGQUERY_DATASET)
+except Exception as e:
+    logger.warning("Could not verify dataset %s at startup: %s", BIGQUERY_DATASET, e)
 
+def _table_exists(table_fq: str) -> bool:
+    """
+    Return True if the table exists. Only positive answers are cached: the load
+    may run on another worker or instance, whose invalidation never reaches us.
+    """
+    with _cache_lock:
+        if table_fq in _table_cache:
+            return True
+    try:
+        bq_client.get_table(table_fq)
+    except NotFound:
+        return False
+    with _cache_lock:
+        _table_cache[table_fq] = True
+    return True
+
+def _invalidate_table_cache(table_fq: str):
+    """Drop cached metadata for a table after it was (re)created."""
+    with _cache_lock:
+        _table_cache.pop(table_fq, None)
+        _schema_cache.pop(table_fq, None)
+        _columns_cache.pop(table_fq, None)
+
+_COLUMN_NAME_INVALID_RE = re.compile(r'[^0-9A-Za-z_]+')
+
+def _bq_column_names(header):
+    """
+    Turn a spreadsheet header row into unique, BigQuery-safe column names.
+    Mirrors what CSV autodetect did: invalid characters become underscores and
+    duplicates (case-insensitive, as in BigQuery) get a numeric suffix.
+    """
+    names, seen = [], set()
+    for i, h in enumerate(header):
+        name = _COLUMN_NAME_INVALID_RE.sub("_", str(h).strip()) if h is not None else ""
+        name = name.strip("_") or f"column_{i}"
+        if name[0].isdigit():
+            name = f"_{name}"
+        base, n = name, 1
+        while name.lower() in seen:
+            name = f"{base}_{n}"
+            n += 1
+        seen.add(name.lower())
+        names.append(name)
+    return names
+
+def _string_array(values):
+    return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+def _is_numeric_type(t):
+    return pa.types.is_boolean(t) or pa.types.is_integer(t) or pa.types.is_floating(t)
+
+def _infer_column_type(values):
+    """Arrow type for one batch of cell values: null if all empty, string if truly mixed."""
+    try:
+        return pa.array(values).type
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Arrow won't mix bools and numbers on its own; spreadsheets do
+        kinds = {type(v) for v in values if v is not None}
+        if kinds <= {bool, int, float}:
+            return pa.float64() if float in kinds else pa.int64()
+        return pa.string()
+
+def _first_batch_type(values):
+    t = _infer_column_type(values)
+    return pa.string() if pa.types.is_null(t) else t  # all-empty columns become strings
+
+def _widen_column_type(current, seen):
+    """Narrowest type holding both: bool < int64 < float64 for numbers, else string."""
+    if current == seen or pa.types.is_null(seen):
+        return current
+    if _is_numeric_type(current) and _is_numeric_type(seen):
+        if pa.types.is_floating(current) or pa.types.is_floating(seen):
+            return pa.float64()
+        return pa.int64()
+    return pa.string()
+
+def _column_array(values, t):
+    """Build one batch of a column as type t, or return None if the values don't fit."""
+    if pa.types.is_string(t):
+        # Numbers or dates in a text column are stringified, not a type change
+        return _string_array(values)
+    # Checked up front: pa.array() would silently truncate 12.5 into an int64 column
+    if _widen_column_type(t, _infer_column_type(values)) != t:
+        return None
+    if pa.types.is_integer(t) or pa.types.is_floating(t):
+        values = [int(v) if isinstance(v, bool) else v for v in values]
+    return pa.array(values, type=t)
+
+def _write_xlsx_parquet(src, dst, batch_size, column_types):
+    """
+    One pass over the workbook. Types come from column_types, else from the first batch.
+    Returns {} once the file is written, or the widened types some column needs; in that
+    case the pass keeps scanning (without writing) so a single retry covers every column.
+    """
+    wb = openpyxl.load_workbook(src, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if not header:
+            raise ValueError("Excel file is empty.")
+        names = _bq_column_names(header)
+        width = len(names)
+
+        widened = {}
+        writer = None
+        try:
+            columns = [[] for _ in range(width)]
+
+            def flush():
+                nonlocal writer
+                if writer is None:
+                    schema = pa.schema([
+                        (name, column_types.get(i) or _first_batch_type(col))
+                        for i, (name, col) in enumerate(zip(names, columns))
+                    ])
+                    writer = pq.ParquetWriter(dst, schema, compression="snappy")
+                arrays = []
+                for i, (col, field) in enumerate(zip(columns, writer.schema)):
+                    t = widened.get(i, field.type)
+                    arr = _column_array(col, t)
+                    if arr is None:
+                        widened[i] = _widen_column_type(t, _infer_column_type(col))
+                    arrays.append(arr)
+                if not widened:
+                    writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=writer.schema))
+                for col in columns:
+                    col.clear()
+
+            for row in rows:
+                for i in range(width):
+                    columns[i].append(row[i] if i < len(row) else None)
+                if len(columns[0]) >= batch_size:
+                    flush()
+            if columns[0] or writer is None:
+                flush()
+        finally:
+            if writer is not None:
+                writer.close()
+    finally:
+        wb.close()
+    return widened
+
+def xlsx_to_parquet_streaming(src, dst, batch_size=50000):
+    """
+    Convert an .xlsx workbook (first sheet) to Parquet without loading it all in memory.
+    Rows are read in openpyxl read-only mode and written in batches of batch_size.
+    Column types come from the first batch; if later rows don't fit (e.g. 12.5 in a
+    column of whole numbers) the column is widened and the workbook read once more.
+    """
+    column_types = {}
+    while True:
+        widened = _write_xlsx_parquet(src, dst, batch_size, column_types)
+        if not widened:
+            return
+        logger.info("Widening Excel columns after the first batch: %s",
+                    {i: str(t) for i, t in widened.items()})
+        column_types.update(widened)
+
+# Formats BigQuery loads as-is, so they can go to GCS straight from the request stream
+SOURCE_FORMATS = {
+    ".csv": bigquery.SourceFormat.CSV,
+    ".json": bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    ".parquet": bigquery.SourceFormat.PARQUET,
+}
+
+def stage_upload(source, filename, table_name):
+    """
+    Upload a supported file to GCS (Excel is converted to Parquet first).
+    `source` is a local path, or a readable stream for formats in SOURCE_FORMATS.
+    Returns (gcs_uri, source_format) ready for load_from_gcs().
+    """
     ext = os.path.splitext(filename)[1].lower()
-    tmp_path = file_path
+    file_path = tmp_path = source
 
-    # Convert Excel to CSV before loading
+    # Convert Excel to Parquet before loading: faster to write than CSV,
+    # smaller to upload, and BigQuery reads the schema from the file
     if ext in [".xls", ".xlsx"]:
-        df = pd.read_excel(file_path)
-        tmp_path = f"/tmp/{table_name}.csv"
-        df.to_csv(tmp_path, index=False)
-        source_format = bigquery.SourceFormat.CSV
-        skip_rows = 1
-    elif ext == ".csv":
-        source_format = bigquery.SourceFormat.CSV
-        skip_rows = 1
-    elif ext == ".json":
-        source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
-        skip_rows = 0
-    elif ext == ".parquet":
+        tmp_path = os.path.join(os.path.dirname(file_path), f"{table_name}.parquet")
+        if ext == ".xlsx":
+            xlsx_to_parquet_streaming(file_path, tmp_path)
+        else:
+            # openpyxl can't read legacy .xls; the Rust-based calamine reader is much faster than xlrd
+            df = pd.read_excel(file_path, engine="calamine")
+            df.columns = _bq_column_names(df.columns)
+            for col in df.columns[df.dtypes == object]:
+                try:
+                    pa.array(df[col], from_pandas=True)
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    # Mixed-type column: keep blanks as nulls, write the rest as text
+                    df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+            df.to_parquet(tmp_path, engine="pyarrow", compression="snappy", index=False)
+        filename = f"{table_name}.parquet"
         source_format = bigquery.SourceFormat.PARQUET
-        skip_rows = 0
+    elif ext in SOURCE_FORMATS:
+        source_format = SOURCE_FORMATS[ext]
     else:
         raise ValueError("Unsupported file type. Use CSV, Excel, JSON, or Parquet.")
 
     # Upload to GCS
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"uploads/{filename}")
-    blob.upload_from_filename(tmp_path)
+    blob = gcs_bucket.blob(f"uploads/{filename}", chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+    if not isinstance(source, str):
+        blob.upload_from_file(source, checksum=GCS_CHECKSUM)
+        return f"gs://{BUCKET_NAME}/uploads/{filename}", source_format
+    try:
+        blob.upload_from_filename(tmp_path, checksum=GCS_CHECKSUM)
+    finally:
+        if tmp_path != file_path:
+            os.unlink(tmp_path)
+
+    return f"gs://{BUCKET_NAME}/uploads/{filename}", source_format
+
+def load_from_gcs(gcs_uri, source_format, table_name):
+    """Load a staged GCS object into BigQuery (no second upload from this instance)."""
+    ensure_dataset_exists(BIGQUERY_DATASET)
 
-    # Load into BigQuery
     table_id = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}"
     job_config = bigquery.LoadJobConfig(
-        autodetect=True,
+        autodetect=source_format != bigquery.SourceFormat.PARQUET,  # Parquet carries its own schema
         source_format=source_format,
-        skip_leading_rows=skip_rows,
+        skip_leading_rows=1 if source_format == bigquery.SourceFormat.CSV else 0,
         write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
     )
 
-    with open(tmp_path, "rb") as source_file:
-        load_job = bq_client.load_table_from_file(source_file, table_id, job_config=job_config)
-
+    load_job = bq_client.load_table_from_uri(gcs_uri, table_id, job_config=job_config)
     load_job.result()
+    _invalidate_table_cache(table_id)
+
+def load_to_bigquery(source, filename, table_name):
+    """Loads supported file types into BigQuery with autodetect schema."""
+    gcs_uri, source_format = stage_upload(source, filename, table_name)
+    load_from_gcs(gcs_uri, source_format, table_name)
+
+# ===============================
+# 🔹 Background jobs (Cloud Tasks)
+# ===============================
+def _job_blob(job_id):
+    return gcs_bucket.blob(f"jobs/{job_id}.json")
+
+def _write_job_status(job_id, **fields):
+    """Persist job status as a small JSON object in GCS (shared by all instances)."""
+    _job_blob(job_id).upload_from_string(orjson.dumps(fields), content_type="application/json")
+
+def _read_job_status(job_id):
+    try:
+        return orjson.loads(_job_blob(job_id).download_as_bytes())
+    except NotFound:
+        return None
+
+def enqueue_load_job(gcs_uri, source_format, table_name, user_email):
+    """Queue the BigQuery load + analysis for a staged upload; returns the job id."""
+    job_id = uuid.uuid4().hex
+    _write_job_status(job_id, status="queued", table=table_name, user=user_email)
+
+    payload = {
+        "job_id": job_id,
+        "uri": gcs_uri,
+        "source_format": source_format,
+        "table": table_name,
+        "user": user_email,
+    }
+    task = {
+        "http_request": {
+            "http_method": tasks_v2.HttpMethod.POST,
+            "url": f"{SERVICE_URL}/internal/process",
+            "headers": {"Content-Type": "application/json"},
+            "body": orjson.dumps(payload),
+            "oidc_token": {"service_account_email": TASKS_SERVICE_ACCOUNT, "audience": SERVICE_URL},
+        }
+    }
+    tasks_client.create_task(parent=tasks_queue_path, task=task)
+    return job_id
+
+def _is_cloud_tasks_request():
+    """Check the OIDC token Cloud Tasks attaches to queued requests."""
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        return False
+    try:
+        claims = id_token.verify_oauth2_token(auth[len("Bearer "):], google_auth_requests.Request(), audience=SERVICE_URL)
+    except ValueError:
+        return False
+    return claims.get("email") == TASKS_SERVICE_ACCOUNT
 
 def run_analysis(table_name):
     """Runs a fresh analysis query, saves results to GCS and BigQuery."""
     ensure_dataset_exists(BIGQUERY_DATASET)
 
-    try:
-        bq_client.get_table(f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}")
-    except Exception:
+    if not _table_exists(f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}"):
         raise ValueError(f"BigQuery table {table_name} not found.")
 
     query = f"SELECT * FROM `{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}` LIMIT 10"
-    results = bq_client.query(query).result()
-
-    local_csv = f"/tmp/{table_name}_results.csv"
-    with open(local_csv, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        headers = [field.name for field in results.schema]
-        writer.writerow(headers)
-        for row in results:
-            writer.writerow(list(row.values()))
-
-    # Upload to GCS
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"analysis_results/{table_name}_results.csv")
-    blob.upload_from_filename(local_csv)
 
     # Save to BigQuery _analysis table
     destination_table = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}_analysis"
@@ -207,7 +613,19 @@ def run_analysis(table_name):
         destination=destination_table,
         write_disposition="WRITE_TRUNCATE"
     )
-    bq_client.query(query, job_config=job_config).result()
+    rows = bq_client.query(query, job_config=job_config).result()
+
+    # Export the analysis table to GCS as CSV; BigQuery can't extract
+    # nested or repeated fields to CSV, so those tables go out as NDJSON
+    if any(_is_nested(f) for f in rows.schema):
+        destination_uri = f"gs://{BUCKET_NAME}/analysis_results/{table_name}_results.json"
+        extract_config = bigquery.ExtractJobConfig(
+            destination_format=bigquery.DestinationFormat.NEWLINE_DELIMITED_JSON
+        )
+    else:
+        destination_uri = f"gs://{BUCKET_NAME}/analysis_results/{table_name}_results.csv"
+        extract_config = None
+    bq_client.extract_table(destination_table, destination_uri, job_config=extract_config).result()
 
     return table_name
 
@@ -219,6 +637,7 @@ def _fq_table(table_name: str) -> str:
     validated_name = validate_table_name(table_name)
     return f"{PROJECT_ID}.{BIGQUERY_DATASET}.{validated_name}"
 
+@cached(_schema_cache, key=lambda table_fq: table_fq, lock=_cache_lock)
 def _table_schema_cols(table_fq: str):
     """Return dict {lower_col_name: (original_name, field)}."""
     tbl = bq_client.get_table(table_fq)
@@ -237,6 +656,7 @@ def _pick_column(cols: dict, candidates, required=True):
         raise ValueError(f"Could not find any of columns: {candidates}")
     return None
 
+@cached(_columns_cache, key=lambda table_fq: table_fq, lock=_cache_lock)
 def _detect_finance_columns(table_fq: str):
     """
     Infer department, amount, date, expense_type column names from the table.
@@ -318,11 +738,93 @@ REPORTS = {
     },
 }
 
+# Templates split once at import into (literal_text, field_name) segments,
+# so rendering is a plain join with no per-request template parsing
+REPORT_SEGMENTS = {
+    rid: tuple((lit, fn) for lit, fn, _, _ in string.Formatter().parse(meta["sql"]))
+    for rid, meta in REPORTS.items()
+}
+REPORT_FIELDS = {
+    rid: tuple(fn for _, fn in segments if fn)
+    for rid, segments in REPORT_SEGMENTS.items()
+}
+
+def _render_report_sql(report_id: str, table_fq: str, cols: dict):
+    """
+    Fill a report template with the detected columns.
+    Returns None if the template needs a column that wasn't detected.
+    """
+    values = dict(cols, table_fq=table_fq)
+    if any(values.get(f) is None for f in REPORT_FIELDS[report_id]):
+        return None
+    return "".join(lit + values[fn] if fn else lit for lit, fn in REPORT_SEGMENTS[report_id])
+
+def _csv_stream(rows):
+    """Yield a query result as CSV bytes, one Arrow record batch at a time."""
+    buf = io.BytesIO()
+    writer = None
+    for batch in rows.to_arrow_iterable(bqstorage_client=bqs_client):
+        if writer is None:
+            writer = pacsv.CSVWriter(buf, batch.schema)
+        writer.write_batch(batch)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if writer is None:
+        # Empty result: still send the header row
+        pacsv.CSVWriter(buf, pa.schema([(f.name, pa.string()) for f in rows.schema]))
+        yield buf.getvalue()
+
+def _is_nested(field):
+    return field.field_type in ("RECORD", "STRUCT") or field.mode == "REPEATED"
+
+def _csv_stream_nested(rows, flush_every=1000):
+    """
+    Yield a query result as CSV bytes row by row, JSON-encoding RECORD/REPEATED cells.
+    Arrow's CSV writer rejects struct and list columns, so results with them take this path.
+    """
+    nested = [_is_nested(f) for f in rows.schema]
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([f.name for f in rows.schema])
+    for n, row in enumerate(rows, 1):
+        writer.writerow([
+            orjson.dumps(v, default=str).decode("utf-8") if is_nested and v is not None else v
+            for v, is_nested in zip(row.values(), nested)
+        ])
+        if n % flush_every == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+def _attachment_header(filename: str) -> str:
+    """Content-Disposition for a download, quoted (and UTF-8 encoded if needed) like send_file."""
+    try:
+        filename.encode("ascii")
+        return dump_options_header("attachment", {"filename": filename})
+    except UnicodeEncodeError:
+        ascii_name = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+        return dump_options_header("attachment", {
+            "filename": ascii_name,
+            "filename*": "UTF-8''" + quote(filename, safe="!#$&+-.^_`|~"),
+        })
+
+def _csv_response(rows, download_name: str):
+    """Stream a query result to the client as a CSV attachment."""
+    # Pick the encoder before the 200 goes out; a failure mid-stream would truncate the file
+    stream = _csv_stream_nested(rows) if any(_is_nested(f) for f in rows.schema) else _csv_stream(rows)
+    return Response(
+        stream,
+        mimetype="text/csv",
+        headers={"Content-Disposition": _attachment_header(download_name)}
+    )
+
 def _run_sql(sql: str, max_rows: int = 1000):
     job = bq_client.query(sql)
     result = job.result(max_results=max_rows)
     columns = [f.name for f in result.schema]
-    rows = [list(row.values()) for row in result]
+    rows = [row.values() for row in result]  # tuples serialize as JSON arrays
     return columns, rows
 
 # ===============================
@@ -341,7 +843,11 @@ def _create_or_replace_view(view_id: str, sql: str):
     except NotFound:
         table = bigquery.Table(view_id)
         table.view_query = sql
-        return bq_client.create_table(table)
+        created = bq_client.create_table(table)
+        _invalidate_table_cache(view_id)
+        return created
+
+MAX_VIEW_WORKERS = 8  # cap concurrent view DDL as the report list grows
 
 def publish_looker_views_for_table(table_name: str) -> dict:
     """
@@ -355,21 +861,26 @@ def publish_looker_views_for_table(table_name: str) -> dict:
     table_fq = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{validated_table_name}"
     cols = _detect_finance_columns(table_fq)
 
-    created = {}
-    for rid, meta in REPORTS.items():
+    jobs = []
+    for rid in REPORTS:
+        sql = _render_report_sql(rid, table_fq, cols)
+        if sql is None:
+            continue  # e.g. no expense_type column for top_expense_types
         view_name = f"{validated_table_name}__{rid}_v"
         view_fq = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{view_name}"
-        sql = meta["sql"].format(
-            table_fq=table_fq,
-            department=cols["department"],
-            amount=cols["amount"],
-            date=cols["date"],
-            expense_type=cols["expense_type"] or "NULL",
-        )
-        _create_or_replace_view(view_fq, sql)
-        created[rid] = view_fq
+        jobs.append((rid, view_fq, sql))
 
-    return created
+    # Views are independent, so create them concurrently
+    created = {}
+    with ThreadPoolExecutor(max_workers=min(MAX_VIEW_WORKERS, len(jobs))) as ex:
+        futures = {ex.submit(_create_or_replace_view, view_fq, sql): (rid, view_fq) for rid, view_fq, sql in jobs}
+        for fut in as_completed(futures):
+            fut.result()
+            rid, view_fq = futures[fut]
+            created[rid] = view_fq
+
+    # Keep the REPORTS order in the response
+    return {rid: created[rid] for rid in REPORTS if rid in created}
 
 # ===============================
 # 🔹 Routes (IAP-protected)
@@ -379,7 +890,7 @@ def publish_looker_views_for_table(table_name: str) -> dict:
 @rate_limit(max_requests=5, window_seconds=60)  # Limit to 5 uploads per minute per user
 def index():
     user_email = current_user_email()
-    logger.info(f"Request from user: {user_email}")
+    logger.info("Request from user: %s", user_email)
 
     if request.method == 'POST':
         uploaded_file = request.files.get('file')
@@ -389,46 +900,77 @@ def index():
         if uploaded_file.filename == '':
             return jsonify({"success": False, "error": "No file selected"}), 400
 
-        file_ext = os.path.splitext(uploaded_file.filename)[1].lower()
-        file_path = f"/tmp/{uploaded_file.filename}"
+        # Split the client filename once; both the extension and the table name derive from it
+        stem, file_ext = os.path.splitext(uploaded_file.filename)
+        file_ext = file_ext.lower()
+        if file_ext not in ALLOWED_EXTENSIONS:
+            # Refuse before anything is written to disk or GCS
+            return jsonify({"success": False, "error": "Unsupported file format. Supported: CSV, Excel, JSON, Parquet, SQL"}), 400
+
+        # Per-request temp dir: no clashes between users uploading the same
+        # filename, and no path traversal via the client-supplied name
+        req_dir = tempfile.mkdtemp(prefix="upl_")
+        file_path = os.path.join(req_dir, secure_filename(uploaded_file.filename) or f"upload{file_ext}")
         
         try:
-            uploaded_file.save(file_path)
-            logger.info(f"File saved: {uploaded_file.filename}")
-
-            table_name = os.path.splitext(uploaded_file.filename)[0].replace(" ", "_").lower()
+            table_name = stem.translate(_TABLE_NAME_TRANS).lower()
             table_name = validate_table_name(table_name)  # Validate table name
+
+            # Only Excel (converted locally) and large SQL dumps (parallel upload) need
+            # a local copy; everything else goes to GCS straight from the request stream
+            parallel_upload = (request.content_length or 0) >= PARALLEL_UPLOAD_THRESHOLD
+            if file_ext in ('.xlsx', '.xls') or (file_ext == '.sql' and parallel_upload):
+                # Stream to disk in large chunks rather than via werkzeug's small-buffer save()
+                with open(file_path, 'wb', buffering=UPLOAD_CHUNK_SIZE) as out:
+                    shutil.copyfileobj(uploaded_file.stream, out, length=UPLOAD_CHUNK_SIZE)
+                logger.info("File saved: %s", uploaded_file.filename)
             
-            logger.info(f"Processing file: {uploaded_file.filename}, table: {table_name}")
+            logger.info("Processing file: %s, table: %s", uploaded_file.filename, table_name)
 
             if file_ext == '.sql':
                 # Upload raw SQL to GCS then notify Pub/Sub
-                bucket = storage_client.bucket(BUCKET_NAME)
-                blob = bucket.blob(f"uploads/{uploaded_file.filename}")
-                blob.upload_from_filename(file_path)
-                logger.info(f"SQL file uploaded to GCS: {uploaded_file.filename}")
+                if parallel_upload:
+                    blob = gcs_bucket.blob(f"uploads/{uploaded_file.filename}")
+                    blob.content_type = 'application/sql'
+                    transfer_manager.upload_chunks_concurrently(
+                        file_path, blob,
+                        chunk_size=PARALLEL_UPLOAD_CHUNK_SIZE,
+                        max_workers=PARALLEL_UPLOAD_WORKERS,
+                        worker_type=transfer_manager.THREAD,
+                    )
+                else:
+                    # Resumable, in chunks, straight from the request stream
+                    blob = gcs_bucket.blob(f"uploads/{uploaded_file.filename}", chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+                    blob.upload_from_file(uploaded_file.stream, content_type='application/sql', checksum=GCS_CHECKSUM)
+                logger.info("SQL file uploaded to GCS: %s", uploaded_file.filename)
 
                 message_data = {'name': uploaded_file.filename, 'bucket': BUCKET_NAME}
-                publisher.publish(topic_path, data=json.dumps(message_data).encode('utf-8'))
-                logger.info(f"Pub/Sub message published for SQL file: {uploaded_file.filename}")
-
-            elif file_ext in ['.xlsx', '.xls']:
-                # Convert Excel to CSV first
-                csv_path = f"/tmp/{table_name}.csv"
-                df = pd.read_excel(file_path)
-                df.to_csv(csv_path, index=False)
-                logger.info(f"Excel file converted to CSV: {uploaded_file.filename}")
-                load_to_bigquery(csv_path, f"{table_name}.csv", table_name)
+                publisher.publish(topic_path, data=orjson.dumps(message_data)).add_done_callback(_log_publish_result)
+                logger.info("Pub/Sub message published for SQL file: %s", uploaded_file.filename)
+
+            elif file_ext in ['.xlsx', '.xls', '.csv', '.json', '.parquet']:
+                source = uploaded_file.stream if file_ext in SOURCE_FORMATS else file_path
+                if TASKS_QUEUE:
+                    # Stage in GCS now; the load + analysis run in /internal/process
+                    gcs_uri, source_format = stage_upload(source, uploaded_file.filename, table_name)
+                    job_id = enqueue_load_job(gcs_uri, source_format, table_name, user_email)
+                    logger.info("Queued load job %s for table: %s", job_id, table_name)
+                    return jsonify({
+                        "success": True,
+                        "message": f"✅ Uploaded {uploaded_file.filename}, analysis queued",
+                        "table": table_name,
+                        "user": user_email,
+                        "job_id": job_id,
+                        "status_url": f"/jobs/{job_id}"
+                    }), 202
+
+                # Excel is converted to Parquet inside load_to_bigquery
+                load_to_bigquery(source, uploaded_file.filename, table_name)
 
-            elif file_ext in ['.csv', '.json', '.parquet']:
-                load_to_bigquery(file_path, uploaded_file.filename, table_name)
-
-            else:
-                return jsonify({"success": False, "error": "Unsupported file format. Supported: CSV, Excel, JSON, Parquet, SQL"}), 400
 
             # Run downstream analysis
             analysis_result = run_analysis(table_name)
-            logger.info(f"Analysis completed for table: {table_name}")
+            logger.info("Analysis completed for table: %s", table_name)
             
             return jsonify({
                 "success": True,
@@ -438,36 +980,80 @@ def index():
             })
 
         except ValueError as ve:
-            logger.error(f"Validation error for {uploaded_file.filename}: {str(ve)}")
+            logger.error("Validation error for %s: %s", uploaded_file.filename, ve)
             return jsonify({"success": False, "error": str(ve)}), 400
         except Exception as e:
-            logger.error(f"Error processing {uploaded_file.filename}: {str(e)}", exc_info=True)
+            logger.error("Error processing %s: %s", uploaded_file.filename, e, exc_info=True)
             return jsonify({"success": False, "error": f"Error processing file: {str(e)}"}), 500
         finally:
             # Clean up temporary files
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                csv_path = f"/tmp/{table_name}.csv"
-                if os.path.exists(csv_path):
-                    os.remove(csv_path)
-            except Exception as cleanup_error:
-                logger.warning(f"Error cleaning up temporary files: {cleanup_error}")
+            shutil.rmtree(req_dir, ignore_errors=True)
 
     return render_template('index.html')
 
+MAX_BATCH_FILES = 50
+
+@app.route('/batch-upload', methods=['POST'])
+@require_user
+@rate_limit(max_requests=5, window_seconds=60)
+def batch_upload():
+    """Bundle several SQL files into one GCS object, one Pub/Sub message and one Cloud SQL import."""
+    user_email = current_user_email()
+    files = [f for f in request.files.getlist('files') if f and f.filename]
+    if not files:
+        return jsonify({"success": False, "error": "No files uploaded"}), 400
+    if len(files) > MAX_BATCH_FILES:
+        return jsonify({"success": False, "error": f"At most {MAX_BATCH_FILES} files per batch"}), 400
+    rejected = [f.filename for f in files if os.path.splitext(f.filename)[1].lower() != '.sql']
+    if rejected:
+        return jsonify({"success": False, "error": f"Only SQL files can be batched: {', '.join(rejected)}"}), 400
+
+    names = [f.filename for f in files]
+    object_name = f"uploads/batch_{uuid.uuid4().hex}.sql"
+    try:
+        # SQL dumps concatenate cleanly; spool them back to back and upload once
+        with tempfile.TemporaryFile() as bundle:
+            for f in files:
+                shutil.copyfileobj(f.stream, bundle, length=UPLOAD_CHUNK_SIZE)
+                bundle.write(b"\n")
+            bundle.seek(0)
+            blob = gcs_bucket.blob(object_name, chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+            blob.upload_from_file(bundle, content_type='application/sql', checksum=GCS_CHECKSUM)
+        logger.info("Batch of %s SQL files uploaded to GCS as %s", len(files), object_name)
+
+        message_data = {'name': object_name, 'bucket': BUCKET_NAME, 'files': names}
+        publisher.publish(topic_path, data=orjson.dumps(message_data)).add_done_callback(_log_publish_result)
+        logger.info("Pub/Sub message published for SQL batch: %s", object_name)
+    except Exception as e:
+        logger.error("Error processing SQL batch from %s: %s", user_email, e, exc_info=True)
+        return jsonify({"success": False, "error": f"Error processing files: {e}"}), 500
+
+    return jsonify({
+        "success": True,
+        "message": f"✅ Uploaded {len(files)} SQL files as one import",
+        "object": object_name,
+        "files": names,
+        "user": user_email
+    })
+
 @app.route('/download/<filename>')
 @require_user
 def download_file(filename):
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"analysis_results/{filename}")
+    blob = gcs_bucket.blob(f"analysis_results/{filename}")
 
     if not blob.exists():
         return f"File {filename} not found in analysis_results folder.", 404
 
-    temp_path = f"/tmp/{filename}"
-    blob.download_to_filename(temp_path)
-    return send_file(temp_path, mimetype='text/csv', as_attachment=True, download_name=filename)
+    def generate():
+        # Stream straight from GCS instead of staging the file in /tmp
+        with blob.open("rb", chunk_size=1024 * 1024) as reader:
+            while chunk := reader.read(1024 * 1024):
+                yield chunk
+
+    # Nested analysis tables are exported as NDJSON (.json), the rest as CSV
+    mimetype = 'application/x-ndjson' if filename.lower().endswith('.json') else 'text/csv'
+    return Response(generate(), mimetype=mimetype,
+                    headers={'Content-Disposition': _attachment_header(filename)})
 
 @app.route('/download_bq')
 @require_user
@@ -484,15 +1070,57 @@ def download_bq():
     query = f"SELECT * FROM `{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}_analysis`"
     results = bq_client.query(query).result()
 
-    temp_path = f"/tmp/{table_name}_analysis.csv"
-    with open(temp_path, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        headers = [field.name for field in results.schema]
-        writer.writerow(headers)
-        for row in results:
-            writer.writerow(list(row.values()))
+    return _csv_response(results, f"{table_name}_analysis.csv")
 
-    return send_file(temp_path, mimetype='text/csv', as_attachment=True, download_name=f"{table_name}_analysis.csv")
+@app.route("/internal/process", methods=["POST"])
+def internal_process():
+    """
+    Cloud Tasks worker: loads a staged upload and runs the analysis.
+    Body JSON: { job_id, uri, source_format, table, user } (see enqueue_load_job)
+    """
+    if not TASKS_QUEUE or not _is_cloud_tasks_request():
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+
+    data = request.get_json(silent=True) or {}
+    job_id = data.get("job_id")
+    table_name = data.get("table")
+    user_email = data.get("user")
+    if not job_id:
+        return jsonify({"success": False, "error": "Missing 'job_id'."}), 400
+    _write_job_status(job_id, status="running", table=table_name, user=user_email)
+
+    try:
+        table_name = validate_table_name(table_name)
+        load_from_gcs(data.get("uri"), data.get("source_format"), table_name)
+        run_analysis(table_name)
+    except ValueError as ve:
+        # Bad input won't succeed on retry, so report it and ack the task
+        logger.error("Job %s failed validation: %s", job_id, ve)
+        _write_job_status(job_id, status="failed", table=table_name, user=user_email, error=str(ve))
+        return jsonify({"success": False, "error": str(ve)}), 200
+    except Exception as e:
+        logger.error("Job %s failed: %s", job_id, e, exc_info=True)
+        _write_job_status(job_id, status="failed", table=table_name, user=user_email, error=str(e))
+        return jsonify({"success": False, "error": str(e)}), 500  # let Cloud Tasks retry
+
+    _write_job_status(job_id, status="done", table=table_name, user=user_email)
+    logger.info("Job %s completed for table: %s", job_id, table_name)
+    return jsonify({"success": True})
+
+@app.route("/jobs/<job_id>")
+@require_user
+def job_status(job_id):
+    """Return the status of a queued upload (queued, running, done or failed)."""
+    status = _read_job_status(job_id) if re.fullmatch(r"[0-9a-f]{32}", job_id) else None
+    if not status or status.get("user") != current_user_email():
+        return jsonify({"success": False, "error": "Job not found."}), 404
+    if status.get("status") in ("done", "failed"):
+        # The owner has seen the outcome; don't let jobs/*.json pile up in the bucket
+        try:
+            _job_blob(job_id).delete()
+        except NotFound:
+            pass
+    return jsonify({"success": True, "job_id": job_id, **status})
 
 @app.route("/whoami")
 @require_user
@@ -505,12 +1133,24 @@ def whoami():
 def healthz():
     return "ok", 200
 
+# Bodies (and ETags) that never change for the life of the process are computed once
+_REPORTS_JSON = app.json.dumps(
+    {"reports": [{"id": k, "label": v["label"]} for k, v in REPORTS.items()]}
+).encode("utf-8")
+_REPORTS_ETAG = hashlib.md5(_REPORTS_JSON).hexdigest()
+
+def _static_json_response(body: bytes, etag: str):
+    """JSON response that browsers may cache and revalidate by ETag (304 on match)."""
+    response = Response(body, mimetype="application/json")
+    response.headers["Cache-Control"] = "private, max-age=300"
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
 @app.route("/reports")
 @require_user
 def list_reports():
     """Return the list of available report ids + labels."""
-    items = [{"id": k, "label": v["label"]} for k, v in REPORTS.items()]
-    return jsonify({"reports": items})
+    return _static_json_response(_REPORTS_JSON, _REPORTS_ETAG)
 
 @app.route("/run_report", methods=["POST"])
 @require_user
@@ -532,13 +1172,9 @@ def run_report():
     try:
         table_fq = _fq_table(table)
         cols = _detect_finance_columns(table_fq)
-        sql = REPORTS[report_id]["sql"].format(
-            table_fq=table_fq,
-            department=cols["department"],
-            amount=cols["amount"],
-            date=cols["date"],
-            expense_type=cols["expense_type"] or "NULL",
-        )
+        sql = _render_report_sql(report_id, table_fq, cols)
+        if sql is None:
+            raise ValueError(f"Table '{table}' has no columns for report '{report_id}'.")
         columns, rows = _run_sql(sql, max_rows=limit)
         return jsonify({
             "success": True,
@@ -564,30 +1200,13 @@ def download_report():
     try:
         table_fq = _fq_table(table)
         cols = _detect_finance_columns(table_fq)
-        sql = REPORTS[report_id]["sql"].format(
-            table_fq=table_fq,
-            department=cols["department"],
-            amount=cols["amount"],
-            date=cols["date"],
-            expense_type=cols["expense_type"] or "NULL",
-        )
+        sql = _render_report_sql(report_id, table_fq, cols)
+        if sql is None:
+            raise ValueError(f"Table '{table}' has no columns for report '{report_id}'.")
         job = bq_client.query(sql)
         result = job.result()
 
-        out = io.StringIO()
-        writer = csv.writer(out)
-        columns = [f.name for f in result.schema]
-        writer.writerow(columns)
-        for row in result:
-            writer.writerow(list(row.values()))
-        out.seek(0)
-
-        return send_file(
-            io.BytesIO(out.read().encode("utf-8")),
-            mimetype="text/csv",
-            as_attachment=True,
-            download_name=f"{report_id}_{table}.csv"
-        )
+        return _csv_response(result, f"{report_id}_{table}.csv")
     except Exception as e:
         return f"Error: {e}", 500
 
@@ -616,19 +1235,22 @@ def looker_help():
     """
     Returns the project/dataset and a short how-to for Looker Studio.
     """
-    return jsonify({
-        "success": True,
-        "project_id": PROJECT_ID,
-        "dataset": BIGQUERY_DATASET,
-        "how_to": [
-            "Open https://lookerstudio.google.com → Create → Report.",
-            "Add data → BigQuery connector.",
-            f"Pick project '{PROJECT_ID}' → dataset '{BIGQUERY_DATASET}'.",
-            "Choose any of the *_v views you created (e.g. finance_data__dept_totals_v).",
-            "Click CONNECT, then add charts (bar/line/pie) as needed."
-        ],
-        "tip": "Re-run /publish_looker_views after uploading a new base table name."
-    })
+    return _static_json_response(_LOOKER_HELP_JSON, _LOOKER_HELP_ETAG)
+
+_LOOKER_HELP_JSON = app.json.dumps({
+    "success": True,
+    "project_id": PROJECT_ID,
+    "dataset": BIGQUERY_DATASET,
+    "how_to": [
+        "Open https://lookerstudio.google.com → Create → Report.",
+        "Add data → BigQuery connector.",
+        f"Pick project '{PROJECT_ID}' → dataset '{BIGQUERY_DATASET}'.",
+        "Choose any of the *_v views you created (e.g. finance_data__dept_totals_v).",
+        "Click CONNECT, then add charts (bar/line/pie) as needed."
+    ],
+    "tip": "Re-run /publish_looker_views after uploading a new base table name."
+}).encode("utf-8")
+_LOOKER_HELP_ETAG = hashlib.md5(_LOOKER_HELP_JSON).hexdigest()
 
 # ===============================
 # 🔹 Start Flask App
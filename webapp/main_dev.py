@@ -4,27 +4,58 @@ This file can be used instead of main.py for local development.
 """
 
 import os
-import json
+import orjson
+import shutil
+import tempfile
 import csv
 import pandas as pd
 import logging
 import time
+import threading
+import uuid
 from functools import wraps
-from flask import Flask, request, render_template, send_file, jsonify, g
+from contextlib import suppress
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from flask import Flask, request, render_template, send_file, jsonify, g, Response
+from flask.json.provider import DefaultJSONProvider
 import redis
 from google.cloud import storage, bigquery
 from google.cloud import pubsub_v1
 import re
 import io
 from google.api_core.exceptions import NotFound
+from google.api_core.client_info import ClientInfo
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson; falls back to Flask's encoder for Decimal, dates, etc."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'local-dev-secret-key')
 
+# Oversize uploads are refused from the Content-Length header, before any of the body is read
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 2 * 1024 * 1024 * 1024))
+
+@app.errorhandler(413)
+def request_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({"success": False, "error": f"File too large. Maximum upload size is {limit_mb} MB."}), 413
+
 # ===============================
 # 🔹 Development Configuration
 # ===============================
@@ -39,17 +70,20 @@ except:
     logger.warning("Redis not available, using in-memory rate limiting")
     redis_client = None
 
-# GCP Clients with emulator support
+# GCP Clients with emulator support (created once at import, shared across requests)
+CLIENT_INFO = ClientInfo(user_agent="gcp-data-analysis/1.0")
+
 def get_gcs_client():
     """Get GCS client with emulator support."""
     if os.environ.get('STORAGE_EMULATOR_HOST'):
         # For local development with emulator
         client = storage.Client(
             project=os.environ.get('GCP_PROJECT', 'local-development'),
+            client_info=CLIENT_INFO,
             client_options={'api_endpoint': os.environ.get('STORAGE_EMULATOR_HOST')}
         )
         return client
-    return storage.Client()
+    return storage.Client(client_info=CLIENT_INFO)
 
 def get_bq_client():
     """Get BigQuery client with emulator support."""
@@ -57,20 +91,30 @@ def get_bq_client():
         # For local development with emulator
         client = bigquery.Client(
             project=os.environ.get('GCP_PROJECT', 'local-development'),
+            client_info=CLIENT_INFO,
             client_options={'api_endpoint': os.environ.get('BIGQUERY_EMULATOR_HOST')}
         )
         return client
-    return bigquery.Client()
+    return bigquery.Client(client_info=CLIENT_INFO)
+
+PUBSUB_BATCH_SETTINGS = pubsub_v1.types.BatchSettings(max_messages=100, max_latency=0.05, max_bytes=1_000_000)
 
 def get_pubsub_client():
     """Get Pub/Sub client with emulator support."""
     if os.environ.get('PUBSUB_EMULATOR_HOST'):
         # For local development with emulator
         client = pubsub_v1.PublisherClient(
+            batch_settings=PUBSUB_BATCH_SETTINGS,
             client_options={'api_endpoint': os.environ.get('PUBSUB_EMULATOR_HOST')}
         )
         return client
-    return pubsub_v1.PublisherClient()
+    return pubsub_v1.PublisherClient(batch_settings=PUBSUB_BATCH_SETTINGS)
+
+def _log_publish_result(future):
+    """Log Pub/Sub publish failures without blocking the request on the future."""
+    exc = future.exception()
+    if exc is not None:
+        logger.error("Pub/Sub publish failed: %s", exc)
 
 # Initialize clients
 storage_client = get_gcs_client()
@@ -82,6 +126,14 @@ PROJECT_ID = os.environ.get('GCP_PROJECT', 'local-development')
 BUCKET_NAME = os.environ.get('BUCKET_NAME', 'local-bucket')
 PUBSUB_TOPIC_FOR_SQL_IMPORT = os.environ.get('PUBSUB_TOPIC_FOR_SQL_IMPORT', 'sql-import-topic')
 BIGQUERY_DATASET = os.environ.get('BIGQUERY_DATASET', 'analysis_dataset')
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB copy buffer for uploads
+GCS_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # resumable upload chunk (multiple of 256 KiB)
+# Scratch files live on tmpfs when available so the upload round-trip stays in RAM
+SCRATCH_DIR = os.environ.get('UPLOAD_TMP_DIR') or ('/dev/shm' if os.access('/dev/shm', os.W_OK) else None)
+
+# Resolved once at import rather than on every upload
+topic_path = publisher.topic_path(PROJECT_ID, PUBSUB_TOPIC_FOR_SQL_IMPORT)
+gcs_bucket = storage_client.bucket(BUCKET_NAME)
 
 # ===============================
 # 🔹 Security Middleware
@@ -98,27 +150,34 @@ def add_security_headers(response):
         response.headers['Content-Security-Policy'] = "default-src 'self'; script-src 'self' 'unsafe-inline'; style-src 'self' 'unsafe-inline'; img-src 'self' data: https:; font-src 'self'; connect-src 'self'"
     return response
 
+# Atomic INCR + EXPIRE-on-first-hit in a single round-trip
+RATE_LIMIT_SCRIPT = redis_client.register_script(
+    "local c = redis.call('INCR', KEYS[1]) "
+    "if c == 1 then redis.call('EXPIRE', KEYS[1], ARGV[1]) end "
+    "return c"
+) if redis_client else None
+
+def _client_ip():
+    """Original client IP: first X-Forwarded-For hop, else the socket peer."""
+    xff = request.headers.get('X-Forwarded-For')
+    return xff.split(',', 1)[0].strip() if xff else request.remote_addr
+
 # Rate limiting with Redis or in-memory
 def rate_limit(max_requests=10, window_seconds=60):
     """Rate limiting decorator with Redis fallback."""
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
+            client_ip = _client_ip()
             now = time.time()
             key = f"rate_limit:{client_ip}"
             
             if redis_client:
                 # Redis-based rate limiting
                 try:
-                    current = redis_client.get(key)
-                    if current and int(current) >= max_requests:
+                    count = RATE_LIMIT_SCRIPT(keys=[key], args=[window_seconds])
+                    if int(count) > max_requests:
                         return jsonify({"error": "Rate limit exceeded. Please try again later."}), 429
-                    
-                    pipe = redis_client.pipeline()
-                    pipe.incr(key)
-                    pipe.expire(key, window_seconds)
-                    pipe.execute()
                 except redis.RedisError:
                     logger.warning("Redis error, falling back to in-memory rate limiting")
                     # Fallback to in-memory
@@ -132,25 +191,24 @@ def rate_limit(max_requests=10, window_seconds=60):
     return decorator
 
 # In-memory rate limiting fallback
-rate_limit_storage = {}
+rate_limit_storage = defaultdict(deque)
 
 def _in_memory_rate_limit(client_ip, max_requests, window_seconds, func):
     """In-memory rate limiting fallback."""
     now = time.time()
+    dq = rate_limit_storage[client_ip]
     
     # Clean old entries
-    rate_limit_storage[client_ip] = [
-        req_time for req_time in rate_limit_storage.get(client_ip, [])
-        if now - req_time < window_seconds
-    ]
+    while dq and now - dq[0] >= window_seconds:
+        dq.popleft()
     
     # Check rate limit
-    if len(rate_limit_storage[client_ip]) >= max_requests:
-        logger.warning(f"Rate limit exceeded for IP: {client_ip}")
+    if len(dq) >= max_requests:
+        logger.warning("Rate limit exceeded for IP: %s", client_ip)
         return jsonify({"error": "Rate limit exceeded. Please try again later."}), 429
     
     # Add current request
-    rate_limit_storage.setdefault(client_ip, []).append(now)
+    dq.append(now)
     
     return func()
 
@@ -184,18 +242,22 @@ def require_user(fn):
 # ===============================
 # 🔹 Helper Functions
 # ===============================
+_TABLE_NAME_RE = re.compile(r'^[a-zA-Z0-9_]{1,128}\Z', re.ASCII)
+_SQL_KEYWORDS = frozenset({'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'DROP', 'CREATE', 'ALTER', 'EXEC', 'UNION', 'WHERE', 'JOIN'})
+_TABLE_NAME_TRANS = str.maketrans(' ', '_')  # filename stem -> table name
+ALLOWED_EXTENSIONS = frozenset({'.sql', '.xlsx', '.xls', '.csv', '.json', '.parquet'})
+
 def validate_table_name(table_name):
     """Strict table name validation to prevent SQL injection."""
     if not table_name:
         raise ValueError("Table name cannot be empty")
     
     # Only allow alphanumeric characters and underscores
-    if not re.match(r'^[a-zA-Z0-9_]{1,128}$', table_name):
+    if not _TABLE_NAME_RE.match(table_name):
         raise ValueError("Invalid table name. Only letters, numbers, and underscores allowed (max 128 chars)")
     
     # Prevent SQL keywords
-    sql_keywords = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'DROP', 'CREATE', 'ALTER', 'EXEC', 'UNION', 'WHERE', 'JOIN'}
-    if table_name.upper() in sql_keywords:
+    if table_name.upper() in _SQL_KEYWORDS:
         raise ValueError("Table name cannot be a SQL keyword")
     
     return table_name
@@ -223,9 +285,14 @@ def load_to_bigquery(file_path, filename, table_name):
 
     # Convert Excel to CSV before loading
     if ext in [".xls", ".xlsx"]:
-        df = pd.read_excel(file_path)
-        tmp_path = f"/tmp/{table_name}.csv"
-        df.to_csv(tmp_path, index=False)
+        df = pd.read_excel(file_path, engine='calamine', dtype=str)  # BigQuery re-infers types from the CSV
+        tmp_path = f"{file_path}.csv"
+        try:
+            df.to_csv(tmp_path, index=False)
+        except Exception:
+            with suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+            raise
         source_format = bigquery.SourceFormat.CSV
         skip_rows = 1
     elif ext == ".csv":
@@ -241,11 +308,14 @@ def load_to_bigquery(file_path, filename, table_name):
         raise ValueError("Unsupported file type. Use CSV, Excel, JSON, or Parquet.")
 
     # Upload to GCS
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"uploads/{filename}")
-    blob.upload_from_filename(tmp_path)
+    blob = gcs_bucket.blob(f"uploads/{filename}", chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+    try:
+        blob.upload_from_filename(tmp_path)
+    finally:
+        if tmp_path != file_path:
+            os.unlink(tmp_path)
 
-    # Load into BigQuery
+    # Load into BigQuery straight from GCS (no second upload from this instance)
     table_id = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}"
     job_config = bigquery.LoadJobConfig(
         autodetect=True,
@@ -254,11 +324,44 @@ def load_to_bigquery(file_path, filename, table_name):
         write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
     )
 
-    with open(tmp_path, "rb") as source_file:
-        load_job = bq_client.load_table_from_file(source_file, table_id, job_config=job_config)
-
+    load_job = bq_client.load_table_from_uri(f"gs://{BUCKET_NAME}/uploads/{filename}", table_id, job_config=job_config)
     load_job.result()
 
+# ===============================
+# 🔹 Background jobs
+# ===============================
+# The dev server runs a single process, so an in-memory registry is enough
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', '4'))
+_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="upload")
+_jobs = TTLCache(maxsize=1024, ttl=3600)  # job_id -> status, forgotten after an hour
+_jobs_lock = threading.Lock()
+
+def _set_job_status(job_id, **fields):
+    with _jobs_lock:
+        _jobs.setdefault(job_id, {}).update(fields, updated=time.time())
+
+def _process_upload(job_id, file_path, filename, table_name):
+    """Load a saved upload into BigQuery off the request thread, then remove it."""
+    _set_job_status(job_id, status="running")
+    try:
+        # load_to_bigquery converts Excel itself and removes its own CSV copy
+        load_to_bigquery(file_path, filename, table_name)
+        _set_job_status(job_id, status="done")
+        logger.info("Background load finished for table: %s", table_name)
+    except Exception as e:
+        logger.error("Background load failed for %s: %s", filename, e, exc_info=True)
+        _set_job_status(job_id, status="failed", error=str(e))
+    finally:
+        with suppress(FileNotFoundError):
+            os.unlink(file_path)
+
+def submit_upload_job(file_path, filename, table_name, user_email):
+    """Queue a saved upload for background loading and return its job id."""
+    job_id = uuid.uuid4().hex
+    _set_job_status(job_id, status="queued", table=table_name, user=user_email)
+    _executor.submit(_process_upload, job_id, file_path, filename, table_name)
+    return job_id
+
 # ===============================
 # 🔹 Routes
 # ===============================
@@ -267,7 +370,7 @@ def load_to_bigquery(file_path, filename, table_name):
 @rate_limit(max_requests=5, window_seconds=60)
 def index():
     user_email = current_user_email()
-    logger.info(f"Request from user: {user_email}")
+    logger.info("Request from user: %s", user_email)
 
     if request.method == 'POST':
         uploaded_file = request.files.get('file')
@@ -277,47 +380,58 @@ def index():
         if uploaded_file.filename == '':
             return jsonify({"success": False, "error": "No file selected"}), 400
 
-        file_ext = os.path.splitext(uploaded_file.filename)[1].lower()
-        file_path = f"/tmp/{uploaded_file.filename}"
-        
+        # Split the client filename once; both the extension and the table name derive from it
+        stem, file_ext = os.path.splitext(uploaded_file.filename)
+        file_ext = file_ext.lower()
+        if file_ext not in ALLOWED_EXTENSIONS:
+            # Refuse before anything is written to disk or GCS
+            return jsonify({"success": False, "error": "Unsupported file format. Supported: CSV, Excel, JSON, Parquet, SQL"}), 400
+        file_path = None
         try:
-            uploaded_file.save(file_path)
-            logger.info(f"File saved: {uploaded_file.filename}")
-
-            table_name = os.path.splitext(uploaded_file.filename)[0].replace(" ", "_").lower()
+            table_name = stem.translate(_TABLE_NAME_TRANS).lower()
             table_name = validate_table_name(table_name)
+
+            # SQL files go straight to GCS; everything else needs a local copy
+            if file_ext != '.sql':
+                # Stream to a uniquely named scratch file in large chunks rather than via
+                # werkzeug's small-buffer save() into a shared /tmp name
+                with tempfile.NamedTemporaryFile(dir=SCRATCH_DIR, suffix=file_ext, delete=False) as out:
+                    file_path = out.name
+                    shutil.copyfileobj(uploaded_file.stream, out, length=UPLOAD_CHUNK_SIZE)
+                logger.info("File saved: %s", uploaded_file.filename)
             
-            logger.info(f"Processing file: {uploaded_file.filename}, table: {table_name}")
+            logger.info("Processing file: %s, table: %s", uploaded_file.filename, table_name)
 
             if file_ext == '.sql':
-                # Upload raw SQL to GCS then notify Pub/Sub
-                bucket = storage_client.bucket(BUCKET_NAME)
-                blob = bucket.blob(f"uploads/{uploaded_file.filename}")
-                blob.upload_from_filename(file_path)
-                logger.info(f"SQL file uploaded to GCS: {uploaded_file.filename}")
+                # Upload raw SQL to GCS straight from the request stream then notify Pub/Sub
+                blob = gcs_bucket.blob(f"uploads/{uploaded_file.filename}", chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+                blob.upload_from_file(uploaded_file.stream, content_type='application/sql')
+                logger.info("SQL file uploaded to GCS: %s", uploaded_file.filename)
 
                 message_data = {'name': uploaded_file.filename, 'bucket': BUCKET_NAME}
                 if os.environ.get('PUBSUB_EMULATOR_HOST'):
                     # Mock Pub/Sub for development
-                    logger.info(f"Mock Pub/Sub message: {message_data}")
+                    logger.info("Mock Pub/Sub message: %s", message_data)
                 else:
-                    publisher.publish(publisher.topic_path(PROJECT_ID, PUBSUB_TOPIC_FOR_SQL_IMPORT), 
-                                    data=json.dumps(message_data).encode('utf-8'))
-                    logger.info(f"Pub/Sub message published for SQL file: {uploaded_file.filename}")
+                    future = publisher.publish(topic_path, data=orjson.dumps(message_data))
+                    future.add_done_callback(_log_publish_result)
+                    logger.info("Pub/Sub message published for SQL file: %s", uploaded_file.filename)
+
+            elif file_ext in ['.xlsx', '.xls', '.csv', '.json', '.parquet']:
+                # The load runs in the background; the job now owns the scratch file
+                job_id = submit_upload_job(file_path, uploaded_file.filename, table_name, user_email)
+                file_path = None
+                logger.info("Queued load job %s for table: %s", job_id, table_name)
+                return jsonify({
+                    "success": True,
+                    "message": f"✅ Uploaded {uploaded_file.filename}, load queued",
+                    "table": table_name,
+                    "user": user_email,
+                    "job_id": job_id,
+                    "status_url": f"/jobs/{job_id}",
+                    "development_mode": True
+                }), 202
 
-            elif file_ext in ['.xlsx', '.xls']:
-                # Convert Excel to CSV first
-                csv_path = f"/tmp/{table_name}.csv"
-                df = pd.read_excel(file_path)
-                df.to_csv(csv_path, index=False)
-                logger.info(f"Excel file converted to CSV: {uploaded_file.filename}")
-                load_to_bigquery(csv_path, f"{table_name}.csv", table_name)
-
-            elif file_ext in ['.csv', '.json', '.parquet']:
-                load_to_bigquery(file_path, uploaded_file.filename, table_name)
-
-            else:
-                return jsonify({"success": False, "error": "Unsupported file format. Supported: CSV, Excel, JSON, Parquet, SQL"}), 400
 
             return jsonify({
                 "success": True,
@@ -328,21 +442,19 @@ def index():
             })
 
         except ValueError as ve:
-            logger.error(f"Validation error for {uploaded_file.filename}: {str(ve)}")
+            logger.error("Validation error for %s: %s", uploaded_file.filename, ve)
             return jsonify({"success": False, "error": str(ve)}), 400
         except Exception as e:
-            logger.error(f"Error processing {uploaded_file.filename}: {str(e)}", exc_info=True)
+            logger.error("Error processing %s: %s", uploaded_file.filename, e, exc_info=True)
             return jsonify({"success": False, "error": f"Error processing file: {str(e)}"}), 500
         finally:
             # Clean up temporary files
             try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                csv_path = f"/tmp/{table_name}.csv"
-                if os.path.exists(csv_path):
-                    os.remove(csv_path)
+                if file_path:
+                    with suppress(FileNotFoundError):
+                        os.unlink(file_path)
             except Exception as cleanup_error:
-                logger.warning(f"Error cleaning up temporary files: {cleanup_error}")
+                logger.warning("Error cleaning up temporary files: %s", cleanup_error)
 
     return render_template('index.html')
 
@@ -351,12 +463,37 @@ def healthz():
     """Health check endpoint."""
     return "ok", 200
 
+@app.route("/jobs/<job_id>")
+@require_user
+def job_status(job_id):
+    """Return the status of a background upload (queued, running, done or failed)."""
+    with _jobs_lock:
+        status = dict(_jobs.get(job_id) or {})
+    if not status or status.get("user") != current_user_email():
+        return jsonify({"success": False, "error": "Job not found."}), 404
+    return jsonify({"success": True, "job_id": job_id, **status})
+
 @app.route("/whoami")
 @require_user
 def whoami():
     """Return the authenticated user's email."""
     return jsonify({"success": True, "email": current_user_email(), "development_mode": IS_DEVELOPMENT})
 
+# Everything /dev-info reports is fixed at import, so the body is encoded once
+_DEV_INFO_JSON = app.json.dumps({
+    "development_mode": True,
+    "gcp_project": PROJECT_ID,
+    "bucket_name": BUCKET_NAME,
+    "bigquery_dataset": BIGQUERY_DATASET,
+    "pubsub_topic": PUBSUB_TOPIC_FOR_SQL_IMPORT,
+    "redis_connected": redis_client is not None,
+    "emulators": {
+        "storage": os.environ.get('STORAGE_EMULATOR_HOST'),
+        "bigquery": os.environ.get('BIGQUERY_EMULATOR_HOST'),
+        "pubsub": os.environ.get('PUBSUB_EMULATOR_HOST')
+    }
+}).encode("utf-8")
+
 @app.route("/dev-info")
 @require_user
 def dev_info():
@@ -364,19 +501,7 @@ def dev_info():
     if not IS_DEVELOPMENT:
         return jsonify({"error": "Not available in production"}), 404
     
-    return jsonify({
-        "development_mode": True,
-        "gcp_project": PROJECT_ID,
-        "bucket_name": BUCKET_NAME,
-        "bigquery_dataset": BIGQUERY_DATASET,
-        "pubsub_topic": PUBSUB_TOPIC_FOR_SQL_IMPORT,
-        "redis_connected": redis_client is not None,
-        "emulators": {
-            "storage": os.environ.get('STORAGE_EMULATOR_HOST'),
-            "bigquery": os.environ.get('BIGQUERY_EMULATOR_HOST'),
-            "pubsub": os.environ.get('PUBSUB_EMULATOR_HOST')
-        }
-    })
+    return Response(_DEV_INFO_JSON, mimetype="application/json")
 
 # ===============================
 # 🔹 Start Flask App
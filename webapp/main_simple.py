@@ -3,13 +3,17 @@ Simple development version that works without GCP credentials.
 """
 
 import os
-import json
+import orjson
+import shutil
+import tempfile
 import csv
 import pandas as pd
 import logging
 import time
 from functools import wraps
-from flask import Flask, request, render_template, send_file, jsonify, g
+from contextlib import suppress
+from flask import Flask, request, render_template, send_file, jsonify, g, Response
+from flask.json.provider import DefaultJSONProvider
 import re
 import io
 
@@ -17,9 +21,30 @@ import io
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson; falls back to Flask's encoder for Decimal, dates, etc."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'local-dev-secret-key')
 
+# Oversize uploads are refused from the Content-Length header, before any of the body is read
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 2 * 1024 * 1024 * 1024))
+
+@app.errorhandler(413)
+def request_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({"success": False, "error": f"File too large. Maximum upload size is {limit_mb} MB."}), 413
+
 # ===============================
 # 🔹 Development Configuration
 # ===============================
@@ -66,7 +91,7 @@ class MockBlob:
         self.name = name
     
     def upload_from_filename(self, filename):
-        logger.info(f"Mock GCS: Uploaded {filename} to {self.name}")
+        logger.info("Mock GCS: Uploaded %s to %s", filename, self.name)
 
 class MockBigQuery:
     def dataset(self, dataset_id):
@@ -96,7 +121,7 @@ class MockPubSub:
         return f"projects/{project_id}/topics/{topic}"
     
     def publish(self, topic, data):
-        logger.info(f"Mock Pub/Sub: Published to {topic}: {data.decode()}")
+        logger.info("Mock Pub/Sub: Published to %s: %s", topic, data.decode())
 
 # Initialize mock clients
 storage_client = MockGCS()
@@ -109,6 +134,10 @@ BUCKET_NAME = os.environ.get('BUCKET_NAME', 'local-bucket')
 PUBSUB_TOPIC_FOR_SQL_IMPORT = os.environ.get('PUBSUB_TOPIC_FOR_SQL_IMPORT', 'sql-import-topic')
 BIGQUERY_DATASET = os.environ.get('BIGQUERY_DATASET', 'analysis_dataset')
 
+# Resolved once at import rather than on every upload
+topic_path = publisher.topic_path(PROJECT_ID, PUBSUB_TOPIC_FOR_SQL_IMPORT)
+gcs_bucket = storage_client.bucket(BUCKET_NAME)
+
 # ===============================
 # 🔹 Security Middleware
 # ===============================
@@ -124,48 +153,77 @@ def add_security_headers(response):
 # ===============================
 # 🔹 Helper Functions
 # ===============================
+_TABLE_NAME_RE = re.compile(r'^[a-zA-Z0-9_]{1,128}\Z', re.ASCII)
+_SQL_KEYWORDS = frozenset({'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'DROP', 'CREATE', 'ALTER', 'EXEC', 'UNION', 'WHERE', 'JOIN'})
+_TABLE_NAME_TRANS = str.maketrans(' ', '_')  # filename stem -> table name
+ALLOWED_EXTENSIONS = frozenset({'.sql', '.xlsx', '.xls', '.csv', '.json'})
+
 def validate_table_name(table_name):
     """Strict table name validation to prevent SQL injection."""
     if not table_name:
         raise ValueError("Table name cannot be empty")
     
     # Only allow alphanumeric characters and underscores
-    if not re.match(r'^[a-zA-Z0-9_]{1,128}$', table_name):
+    if not _TABLE_NAME_RE.match(table_name):
         raise ValueError("Invalid table name. Only letters, numbers, and underscores allowed (max 128 chars)")
     
     # Prevent SQL keywords
-    sql_keywords = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'DROP', 'CREATE', 'ALTER', 'EXEC', 'UNION', 'WHERE', 'JOIN'}
-    if table_name.upper() in sql_keywords:
+    if table_name.upper() in _SQL_KEYWORDS:
         raise ValueError("Table name cannot be a SQL keyword")
     
     return table_name
 
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 4 MiB copy buffer for uploads
+# Scratch files live on tmpfs when available so the upload round-trip stays in RAM
+SCRATCH_DIR = os.environ.get('UPLOAD_TMP_DIR') or ('/dev/shm' if os.access('/dev/shm', os.W_OK) else None)
+
+def _save_upload(uploaded_file, suffix=''):
+    """Stream an upload to a unique scratch file with one large buffer instead of werkzeug's 16 KiB save()."""
+    with tempfile.NamedTemporaryFile(dir=SCRATCH_DIR, suffix=suffix, delete=False, buffering=0) as dst:
+        try:
+            if request.content_length and hasattr(os, 'posix_fallocate'):
+                # Reserve space up front (the multipart body bounds the file size),
+                # then trim to the bytes actually written
+                os.posix_fallocate(dst.fileno(), 0, request.content_length)
+            shutil.copyfileobj(uploaded_file.stream, dst, length=UPLOAD_CHUNK_SIZE)
+            dst.truncate(dst.tell())
+        except BaseException:
+            # Don't leave a preallocated file behind in SCRATCH_DIR (RAM-backed /dev/shm)
+            os.unlink(dst.name)
+            raise
+    return dst.name
+
 def load_to_bigquery(file_path, filename, table_name):
     """Mock BigQuery loading for development."""
-    logger.info(f"Mock BigQuery: Loading {filename} into table {table_name}")
+    logger.info("Mock BigQuery: Loading %s into table %s", filename, table_name)
     
     # Read and validate the file
     ext = os.path.splitext(filename)[1].lower()
     
     if ext in [".xls", ".xlsx"]:
         df = pd.read_excel(file_path)
-        logger.info(f"Mock: Processed Excel file with {len(df)} rows")
+        logger.info("Mock: Processed Excel file with %s rows", len(df))
     elif ext == ".csv":
         df = pd.read_csv(file_path)
-        logger.info(f"Mock: Processed CSV file with {len(df)} rows")
+        logger.info("Mock: Processed CSV file with %s rows", len(df))
     elif ext == ".json":
         df = pd.read_json(file_path, lines=True)
-        logger.info(f"Mock: Processed JSON file with {len(df)} rows")
+        logger.info("Mock: Processed JSON file with %s rows", len(df))
     else:
         raise ValueError("Unsupported file type. Use CSV, Excel, or JSON.")
     
     # Mock upload to GCS
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"uploads/{filename}")
+    blob = gcs_bucket.blob(f"uploads/{filename}")
     blob.upload_from_filename(file_path)
     
     return True
 
+# Upload success body: constant keys pre-encoded, variable parts JSON-encoded with orjson
+_UPLOAD_OK_TEMPLATE = (
+    b'{"success":true,"message":%s,"table":%s,"user":%s,'
+    b'"development_mode":true,"mock_mode":true}'
+)
+
 # ===============================
 # 🔹 Routes
 # ===============================
@@ -173,7 +231,7 @@ def load_to_bigquery(file_path, filename, table_name):
 @require_user
 def index():
     user_email = current_user_email()
-    logger.info(f"Request from user: {user_email}")
+    logger.info("Request from user: %s", user_email)
 
     if request.method == 'POST':
         uploaded_file = request.files.get('file')
@@ -183,58 +241,58 @@ def index():
         if uploaded_file.filename == '':
             return jsonify({"success": False, "error": "No file selected"}), 400
 
-        file_ext = os.path.splitext(uploaded_file.filename)[1].lower()
-        file_path = f"/tmp/{uploaded_file.filename}"
+        # Split the client filename once; both the extension and the table name derive from it
+        stem, file_ext = os.path.splitext(uploaded_file.filename)
+        file_ext = file_ext.lower()
+        if file_ext not in ALLOWED_EXTENSIONS:
+            # Refuse before anything is written to disk or GCS
+            return jsonify({"success": False, "error": "Unsupported file format. Supported: CSV, Excel, JSON, SQL"}), 400
+        file_path = None
         
         try:
-            uploaded_file.save(file_path)
-            logger.info(f"File saved: {uploaded_file.filename}")
+            file_path = _save_upload(uploaded_file, file_ext)
+            logger.info("File saved: %s", uploaded_file.filename)
 
-            table_name = os.path.splitext(uploaded_file.filename)[0].replace(" ", "_").lower()
+            table_name = stem.translate(_TABLE_NAME_TRANS).lower()
             table_name = validate_table_name(table_name)
             
-            logger.info(f"Processing file: {uploaded_file.filename}, table: {table_name}")
+            logger.info("Processing file: %s, table: %s", uploaded_file.filename, table_name)
 
             if file_ext == '.sql':
                 # Mock SQL processing
-                bucket = storage_client.bucket(BUCKET_NAME)
-                blob = bucket.blob(f"uploads/{uploaded_file.filename}")
+                blob = gcs_bucket.blob(f"uploads/{uploaded_file.filename}")
                 blob.upload_from_filename(file_path)
-                logger.info(f"Mock: SQL file uploaded to GCS: {uploaded_file.filename}")
+                logger.info("Mock: SQL file uploaded to GCS: %s", uploaded_file.filename)
 
                 message_data = {'name': uploaded_file.filename, 'bucket': BUCKET_NAME}
-                publisher.publish(publisher.topic_path(PROJECT_ID, PUBSUB_TOPIC_FOR_SQL_IMPORT), 
-                                data=json.dumps(message_data).encode('utf-8'))
-                logger.info(f"Mock: Pub/Sub message published for SQL file: {uploaded_file.filename}")
+                publisher.publish(topic_path, data=orjson.dumps(message_data))
+                logger.info("Mock: Pub/Sub message published for SQL file: %s", uploaded_file.filename)
 
             elif file_ext in ['.xlsx', '.xls', '.csv', '.json']:
                 load_to_bigquery(file_path, uploaded_file.filename, table_name)
 
-            else:
-                return jsonify({"success": False, "error": "Unsupported file format. Supported: CSV, Excel, JSON, SQL"}), 400
 
-            return jsonify({
-                "success": True,
-                "message": f"✅ Uploaded {uploaded_file.filename} successfully (Mock Mode)",
-                "table": table_name,
-                "user": user_email,
-                "development_mode": True,
-                "mock_mode": True
-            })
+            body = _UPLOAD_OK_TEMPLATE % (
+                orjson.dumps(f"✅ Uploaded {uploaded_file.filename} successfully (Mock Mode)"),
+                orjson.dumps(table_name),
+                orjson.dumps(user_email),
+            )
+            return Response(body, mimetype="application/json")
 
         except ValueError as ve:
-            logger.error(f"Validation error for {uploaded_file.filename}: {str(ve)}")
+            logger.error("Validation error for %s: %s", uploaded_file.filename, ve)
             return jsonify({"success": False, "error": str(ve)}), 400
         except Exception as e:
-            logger.error(f"Error processing {uploaded_file.filename}: {str(e)}", exc_info=True)
+            logger.error("Error processing %s: %s", uploaded_file.filename, e, exc_info=True)
             return jsonify({"success": False, "error": f"Error processing file: {str(e)}"}), 500
         finally:
             # Clean up temporary files
             try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+                if file_path:
+                    with suppress(FileNotFoundError):
+                        os.unlink(file_path)
             except Exception as cleanup_error:
-                logger.warning(f"Error cleaning up temporary files: {cleanup_error}")
+                logger.warning("Error cleaning up temporary files: %s", cleanup_error)
 
     return render_template('index.html')
 
@@ -249,19 +307,22 @@ def whoami():
     """Return the authenticated user's email."""
     return jsonify({"success": True, "email": current_user_email(), "development_mode": IS_DEVELOPMENT, "mock_mode": True})
 
+# Everything /dev-info reports is fixed at import, so the body is encoded once
+_DEV_INFO_JSON = app.json.dumps({
+    "development_mode": True,
+    "mock_mode": True,
+    "gcp_project": PROJECT_ID,
+    "bucket_name": BUCKET_NAME,
+    "bigquery_dataset": BIGQUERY_DATASET,
+    "pubsub_topic": PUBSUB_TOPIC_FOR_SQL_IMPORT,
+    "message": "Running in mock mode - no real GCP operations"
+}).encode("utf-8")
+
 @app.route("/dev-info")
 @require_user
 def dev_info():
     """Development information endpoint."""
-    return jsonify({
-        "development_mode": True,
-        "mock_mode": True,
-        "gcp_project": PROJECT_ID,
-        "bucket_name": BUCKET_NAME,
-        "bigquery_dataset": BIGQUERY_DATASET,
-        "pubsub_topic": PUBSUB_TOPIC_FOR_SQL_IMPORT,
-        "message": "Running in mock mode - no real GCP operations"
-    })
+    return Response(_DEV_INFO_JSON, mimetype="application/json")
 
 # ===============================
 # 🔹 Start Flask App